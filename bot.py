@@ -1,155 +1,880 @@
-from telegram import Update
+from telegram import Message, Update
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     filters,
     CallbackContext,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler
 )
-import subprocess
+import functools
+import hashlib
+import io
 import os
+import resource
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import errno
+import pty
+import tty
+import platform
+import tempfile
+import time
 import logging
-import re
 import asyncio
 from asyncio.subprocess import PIPE
+from collections import Counter, OrderedDict
+from urllib.parse import urlsplit
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import Frame, Paragraph, Preformatted, SimpleDocTemplate
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 TOKEN = os.getenv('TOKEN')
 if not TOKEN:
     raise ValueError("No TOKEN provided in environment variables!")
 
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+PORT = int(os.getenv('PORT', '8443'))
+
 CODE, RUNNING = range(2)
 
+COMPILE_TIMEOUT = 15
+RUN_TIMEOUT = 5
+INPUT_TIMEOUT = 60
+STOP_TIMEOUT = 2
+CONVERSATION_TIMEOUT = 5 * 60
+MAX_OUTPUT = 64 * 1024
+MESSAGE_LIMIT = 4096
+FLUSH_SIZE = 3500
+FLUSH_DELAY = 0.5
+READ_SIZE = 64 * 1024
+INPUT_POLL_INTERVAL = 0.2
+READ_SYSCALL = {"x86_64": "0", "aarch64": "63"}.get(platform.machine())
+GCC_FLAGS = ("-O0", "-pipe", "-fno-asynchronous-unwind-tables", "-fno-stack-protector", "-fno-lto", "-s")
+RUN_CPU_LIMIT = 5
+RUN_MEMORY_LIMIT = 128 * 1024 * 1024
+RUN_FILE_LIMIT = 16 * 1024 * 1024
+RUN_OPEN_FILES = 64
+RUN_PROCESS_LIMIT = 64
+CGROUP_SIGNAL_PASSES = 8
+PROGRAM_ENV = {"PATH": "/usr/bin:/bin", "LANG": "C.UTF-8"}
+BWRAP = shutil.which('bwrap')
+ALLOW_UNSANDBOXED = os.getenv('ALLOW_UNSANDBOXED') == '1'
+CGROUP_DIR = os.getenv('CGROUP_DIR')
+GCC = shutil.which('gcc') or 'gcc'
+TCC = shutil.which('tcc') if os.getenv('USE_TCC') == '1' else None
+MAX_COMPILES = os.cpu_count() or 1
+MAX_RUNNING = 2 * MAX_COMPILES
+MAX_UPDATES = 64
+
+WORK_ROOT = os.getenv('WORK_ROOT', '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+WORK_DIR = os.path.join(WORK_ROOT, 'ccode2pdfbot')
+STALE_WORKDIR_AGE = 60 * 60
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ccode2pdfbot'))
+CACHE_SIZE = 256
+
+PDF_STYLES = getSampleStyleSheet()
+PDF_FONT = os.getenv('PDF_FONT')
+PDF_FONT_FILE = "DejaVuSansMono.ttf"
+FONT_DIRS = (
+    "/usr/share/fonts",
+    os.path.expanduser("~/.nix-profile/share/fonts"),
+    "/nix/var/nix/profiles/default/share/fonts",
+    "/run/current-system/sw/share/fonts",
+)
+PDF_SECTIONS = ("Source Code", "Program Output", "Errors (if any)")
+PDF_CACHE_SIZE = 1024
+
+compiled_binaries = OrderedDict()
+sent_pdfs = OrderedDict()
+compile_locks = {}
+compile_waiters = Counter()
+running_processes = set()
+program_cgroups = {}
+cleanup_tasks = set()
+compile_slots = asyncio.Semaphore(MAX_COMPILES)
+pending_compiles = 0
+
 async def start(update: Update, context: CallbackContext) -> int:
     await update.message.reply_text(
         'Hi! Send me your C code to compile. I’ll run it like a console, prompting for input step-by-step.'
     )
     return CODE
 
+def remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error("Could not remove %s: %s", path, e)
+
+async def run_compiler(command: list[str], code: str, workdir: str) -> tuple[int, bytes]:
+    global pending_compiles
+    pending_compiles += 1
+    try:
+        async with compile_slots:
+            compile_process = await asyncio.create_subprocess_exec(
+                *command, cwd=workdir, stdin=PIPE, stdout=PIPE, stderr=PIPE
+            )
+            try:
+                async with asyncio.timeout(COMPILE_TIMEOUT):
+                    _, compile_stderr = await compile_process.communicate(code.encode())
+            except TimeoutError:
+                compile_process.kill()
+                await compile_process.wait()
+                raise
+    finally:
+        pending_compiles -= 1
+    return compile_process.returncode, compile_stderr
+
+async def check_syntax(code: str, workdir: str) -> tuple[int, bytes]:
+    return await run_compiler([GCC, "-fsyntax-only", "-x", "c", "-"], code, workdir)
+
+def make_private_dir(path: str) -> None:
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a directory owned by the bot's user")
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+
+def evict_compiled_binaries() -> None:
+    while len(compiled_binaries) > CACHE_SIZE:
+        _, evicted_path = compiled_binaries.popitem(last=False)
+        remove_file(evicted_path)
+
+def load_compiled_binaries() -> None:
+    entries = [entry for entry in os.scandir(CACHE_DIR) if entry.is_file()]
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        if entry.name.endswith(".tmp"):
+            remove_file(entry.path)
+        else:
+            compiled_binaries[entry.name] = entry.path
+    evict_compiled_binaries()
+
+def remove_stale_workdirs() -> None:
+    cutoff = time.time() - STALE_WORKDIR_AGE
+    for entry in os.scandir(WORK_DIR):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("Could not remove %s: %s", entry.path, e)
+
+async def compile_code(code: str, workdir: str) -> tuple[str | None, bytes]:
+    key = hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+    binary_path = os.path.join(CACHE_DIR, key)
+    lock = compile_locks.setdefault(key, asyncio.Lock())
+    compile_waiters[key] += 1
+    try:
+        async with lock:
+            if os.path.exists(binary_path):
+                os.utime(binary_path)
+                compiled_binaries[key] = binary_path
+                compiled_binaries.move_to_end(key)
+                return binary_path, b""
+
+            partial_path = binary_path + ".tmp"
+            try:
+                if TCC:
+                    command = [TCC, "-o", partial_path, "-xc", "-"]
+                else:
+                    command = [GCC, *GCC_FLAGS, "-o", partial_path, "-x", "c", "-"]
+                returncode, compile_stderr = await run_compiler(command, code, workdir)
+            except TimeoutError:
+                remove_file(partial_path)
+                raise
+
+            if returncode != 0:
+                return None, compile_stderr
+
+            os.replace(partial_path, binary_path)
+            compiled_binaries[key] = binary_path
+            evict_compiled_binaries()
+            return binary_path, compile_stderr
+    finally:
+        compile_waiters[key] -= 1
+        if not compile_waiters[key]:
+            del compile_waiters[key], compile_locks[key]
+
+def prepare_cgroups() -> None:
+    os.makedirs(CGROUP_DIR, exist_ok=True)
+    for entry in os.scandir(CGROUP_DIR):
+        if entry.name.startswith("bot-") and entry.is_dir():
+            signal_cgroup(entry.path, signal.SIGKILL)
+            try:
+                os.rmdir(entry.path)
+            except OSError as e:
+                logger.error("Could not remove cgroup %s: %s", entry.path, e)
+    subtree_control = os.path.join(CGROUP_DIR, "cgroup.subtree_control")
+    try:
+        if os.path.exists(subtree_control):
+            with open(subtree_control, "w") as f:
+                f.write("+pids")
+        os.rmdir(create_cgroup("bot-probe"))
+    except OSError as e:
+        raise RuntimeError(f"CGROUP_DIR {CGROUP_DIR} cannot set pids.max; is the pids controller enabled? ({e})") from e
+
+def create_cgroup(name: str) -> str:
+    cgroup = os.path.join(CGROUP_DIR, name)
+    os.mkdir(cgroup)
+    try:
+        with open(os.path.join(cgroup, "pids.max"), "w") as f:
+            f.write(str(RUN_PROCESS_LIMIT))
+    except BaseException:
+        os.rmdir(cgroup)
+        raise
+    return cgroup
+
+def signal_cgroup(cgroup: str, sig: int) -> None:
+    kill_file = os.path.join(cgroup, "cgroup.kill")
+    if sig == signal.SIGKILL and os.path.exists(kill_file):
+        with open(kill_file, "w") as f:
+            f.write("1")
+        return
+    signalled = set()
+    for _ in range(CGROUP_SIGNAL_PASSES if sig == signal.SIGKILL else 1):
+        try:
+            with open(os.path.join(cgroup, "cgroup.procs")) as f:
+                pids = set(f.read().split()) - signalled
+        except FileNotFoundError:
+            return
+        if not pids:
+            return
+        for pid in pids:
+            try:
+                os.kill(int(pid), sig)
+            except ProcessLookupError:
+                pass
+        signalled |= pids
+
+async def remove_cgroup(cgroup: str) -> None:
+    try:
+        async with asyncio.timeout(STOP_TIMEOUT):
+            while True:
+                signal_cgroup(cgroup, signal.SIGKILL)
+                try:
+                    os.rmdir(cgroup)
+                    return
+                except FileNotFoundError:
+                    return
+                except OSError as e:
+                    if e.errno != errno.EBUSY:
+                        raise
+                await asyncio.sleep(INPUT_POLL_INTERVAL)
+    except (OSError, TimeoutError) as e:
+        logger.error("Could not remove cgroup %s: %s", cgroup, e)
+
+def limit_resources(cgroup: str | None) -> None:
+    if cgroup:
+        with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+            f.write("0")
+    resource.setrlimit(resource.RLIMIT_CPU, (RUN_CPU_LIMIT, RUN_CPU_LIMIT))
+    resource.setrlimit(resource.RLIMIT_AS, (RUN_MEMORY_LIMIT, RUN_MEMORY_LIMIT))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (RUN_FILE_LIMIT, RUN_FILE_LIMIT))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (RUN_OPEN_FILES, RUN_OPEN_FILES))
+
+def program_command(binary_path: str) -> list[str]:
+    if not BWRAP:
+        return [binary_path]
+    return [
+        BWRAP, "--unshare-all", "--die-with-parent", "--new-session",
+        "--ro-bind", "/usr", "/usr",
+        "--ro-bind-try", "/lib", "/lib",
+        "--ro-bind-try", "/lib64", "/lib64",
+        "--ro-bind-try", "/nix", "/nix",
+        "--proc", "/proc",
+        "--dev", "/dev",
+        "--tmpfs", "/tmp",
+        "--tmpfs", "/work",
+        "--ro-bind", binary_path, "/program",
+        "--chdir", "/work",
+        "--", "/program",
+    ]
+
+def sandbox_works() -> bool:
+    try:
+        result = subprocess.run(
+            program_command(shutil.which('true') or '/bin/true'),
+            env=PROGRAM_ENV,
+            capture_output=True,
+            timeout=COMPILE_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error("bwrap could not be started: %s", e)
+        return False
+    if result.returncode != 0:
+        logger.error("bwrap cannot create a sandbox on this host: %s", result.stderr.decode(errors="replace").strip())
+        return False
+    return True
+
+class TerminalReaderProtocol(asyncio.StreamReaderProtocol):
+    def connection_lost(self, exc: Exception | None) -> None:
+        if isinstance(exc, OSError) and exc.errno == errno.EIO:
+            exc = None
+        super().connection_lost(exc)
+
+async def start_program(binary_path: str, workdir: str) -> tuple[asyncio.subprocess.Process, int]:
+    cgroup = create_cgroup(os.path.basename(workdir)) if CGROUP_DIR else None
+    try:
+        master, terminal = pty.openpty()
+    except BaseException:
+        if cgroup:
+            os.rmdir(cgroup)
+        raise
+    try:
+        tty.setraw(terminal)
+        process = await asyncio.create_subprocess_exec(
+            *program_command(binary_path),
+            cwd=workdir,
+            env=PROGRAM_ENV,
+            stdin=terminal,
+            stdout=terminal,
+            stderr=PIPE,
+            preexec_fn=functools.partial(limit_resources, cgroup),
+            start_new_session=True
+        )
+    except BaseException:
+        os.close(master)
+        if cgroup:
+            os.rmdir(cgroup)
+        raise
+    finally:
+        os.close(terminal)
+    running_processes.add(process)
+    if cgroup:
+        program_cgroups[process] = cgroup
+
+    loop = asyncio.get_running_loop()
+    process.stdout = asyncio.StreamReader(limit=READ_SIZE, loop=loop)
+    await loop.connect_read_pipe(
+        lambda: TerminalReaderProtocol(process.stdout, loop=loop), open(master, 'rb', buffering=0)
+    )
+    terminal = os.dup(master)
+    os.set_blocking(terminal, False)
+    return process, terminal
+
+async def write_input(terminal: int, data: bytes) -> None:
+    async with asyncio.timeout(RUN_TIMEOUT):
+        while data:
+            try:
+                data = data[os.write(terminal, data):]
+            except BlockingIOError:
+                await asyncio.sleep(INPUT_POLL_INTERVAL)
+
+def signal_program(process: asyncio.subprocess.Process, sig: int) -> None:
+    cgroup = program_cgroups.get(process)
+    if cgroup:
+        signal_cgroup(cgroup, sig)
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+async def stop_program(process: asyncio.subprocess.Process) -> None:
+    signal_program(process, signal.SIGTERM)
+    try:
+        async with asyncio.timeout(STOP_TIMEOUT):
+            await process.wait()
+    except TimeoutError:
+        signal_program(process, signal.SIGKILL)
+        await process.wait()
+    cgroup = program_cgroups.pop(process, None)
+    if cgroup:
+        await remove_cgroup(cgroup)
+
+async def check(update: Update, context: CallbackContext) -> int:
+    context.user_data['check_only'] = True
+    await update.message.reply_text('Send me your C code and I’ll check it for compilation errors without running it.')
+    return CODE
+
 async def handle_code(update: Update, context: CallbackContext) -> int:
-    code = update.message.text
-    context.user_data.clear()
-    context.user_data.update({'code': code, 'output': [], 'inputs': [], 'errors': [], 'waiting_for_input': False})
+    message = update.message
+    user_data = context.user_data
+    code = message.text
+    check_only = user_data.get('check_only', False)
+    await cleanup(context)
+    workdir = tempfile.mkdtemp(prefix=f"bot-{update.effective_chat.id}-", dir=WORK_DIR)
+    user_data.update({
+        'code': code, 'output': [], 'inputs': [], 'errors': [], 'waiting_for_input': False, 'workdir': workdir,
+        'output_size': 0, 'pending': [], 'pending_size': 0, 'flush_task': None, 'reply_lock': asyncio.Lock(),
+        'line_lock': asyncio.Lock(), 'stdout_partial': b"", 'stderr_partial': b""
+    })
 
     try:
-        with open("temp.c", "w") as file:
-            file.write(code)
-        
-        compile_result = subprocess.run(["gcc", "temp.c", "-o", "temp"], capture_output=True, text=True)
+        if check_only:
+            returncode, compile_stderr = await check_syntax(code, workdir)
+            if returncode != 0:
+                await reply_in_chunks(message, f"Compilation Error:\n{compile_stderr.decode()}")
+            else:
+                await message.reply_text("No compilation errors found.")
+            await cleanup(context)
+            return ConversationHandler.END
+
+        if not BWRAP and not ALLOW_UNSANDBOXED:
+            await message.reply_text(
+                "Running programs is disabled because the sandbox (bubblewrap) is not available. "
+                "Use /check to check your code for compilation errors."
+            )
+            await cleanup(context)
+            return ConversationHandler.END
 
-        if compile_result.returncode != 0:
-            await update.message.reply_text(f"Compilation Error:\n{compile_result.stderr}")
+        binary_path, compile_stderr = await compile_code(code, workdir)
+        if binary_path is None:
+            await reply_in_chunks(message, f"Compilation Error:\n{compile_stderr.decode()}")
+            await cleanup(context)
             return ConversationHandler.END
         
-        process = await asyncio.create_subprocess_exec("./temp", stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        context.user_data['process'] = process
-        asyncio.create_task(read_process_output(update, context))
+        if len(running_processes) >= MAX_RUNNING:
+            await message.reply_text("Too many programs are running right now. Please try again in a minute.")
+            await cleanup(context)
+            return ConversationHandler.END
+
+        process, terminal = await start_program(binary_path, workdir)
+        runner = asyncio.create_task(run_program(update, context))
+        runner.add_done_callback(lambda _: release_program(process, terminal, workdir))
+        user_data.update({'process': process, 'terminal': terminal, 'runner': runner})
         
-        await update.message.reply_text("Code compiled successfully! The program is running. Type /cancel to stop.")
+        await message.reply_text("Code compiled successfully! The program is running. Type /cancel to stop.")
         return RUNNING
+
+    except TimeoutError:
+        await message.reply_text(f"Compilation timed out after {COMPILE_TIMEOUT} seconds.")
+        await cleanup(context)
+        return ConversationHandler.END
     
     except Exception as e:
-        await update.message.reply_text(f"An error occurred: {str(e)}")
+        await message.reply_text(f"An error occurred: {str(e)}")
+        await cleanup(context)
         return ConversationHandler.END
 
-async def read_process_output(update: Update, context: CallbackContext):
-    process = context.user_data['process']
+def split_message(text: str) -> list[str]:
+    if len(text.encode("utf-16-le")) <= 2 * MESSAGE_LIMIT:
+        return [text]
+    chunks = []
+    start = units = 0
+    for i, char in enumerate(text):
+        width = 2 if ord(char) > 0xFFFF else 1
+        if units + width > MESSAGE_LIMIT:
+            chunks.append(text[start:i])
+            start, units = i, 0
+        units += width
+    chunks.append(text[start:])
+    return chunks
+
+async def reply_in_chunks(message: Message, text: str):
+    for chunk in split_message(text):
+        await message.reply_text(chunk)
+
+async def queue_reply(update: Update, context: CallbackContext, text: str):
+    user_data = context.user_data
+    user_data['pending'].append(text)
+    user_data['pending_size'] += len(text) + 1
+    if user_data['pending_size'] >= FLUSH_SIZE:
+        await flush_replies(update, context)
+    elif user_data['flush_task'] is None:
+        user_data['flush_task'] = asyncio.create_task(flush_replies_later(update, context))
+
+async def flush_replies_later(update: Update, context: CallbackContext):
+    await asyncio.sleep(FLUSH_DELAY)
+    context.user_data['flush_task'] = None
+    await flush_replies(update, context)
+
+async def flush_replies(update: Update, context: CallbackContext):
+    user_data = context.user_data
+    flush_task = user_data['flush_task']
+    if flush_task:
+        flush_task.cancel()
+        user_data['flush_task'] = None
+    async with user_data['reply_lock']:
+        if not user_data['pending']:
+            return
+        text = "\n".join(user_data['pending'])
+        user_data['pending'].clear()
+        user_data['pending_size'] = 0
+        await reply_in_chunks(update.message, text)
+
+def is_prompt(line: str) -> bool:
+    return line.endswith(":") or "enter" in line.lower()
+
+async def read_stream(stream: asyncio.StreamReader, update: Update, context: CallbackContext, is_stderr: bool):
+    user_data = context.user_data
+    key = 'stderr_partial' if is_stderr else 'stdout_partial'
+    while chunk := await stream.read(READ_SIZE):
+        user_data['output_size'] += len(chunk)
+        if user_data['output_size'] > MAX_OUTPUT:
+            await stop_for_output_limit(update, context)
+            return
+
+        async with user_data['line_lock']:
+            *raw_lines, partial = (user_data[key] + chunk).split(b"\n")
+            if not is_stderr and is_prompt(partial.strip().decode(errors="replace")):
+                raw_lines.append(partial)
+                partial = b""
+            user_data[key] = partial
+            for raw_line in raw_lines:
+                await handle_line(raw_line, update, context, is_stderr)
+    async with user_data['line_lock']:
+        partial, user_data[key] = user_data[key], b""
+        await handle_line(partial, update, context, is_stderr)
+
+async def handle_line(raw_line: bytes, update: Update, context: CallbackContext, is_stderr: bool):
+    user_data = context.user_data
+    stripped = raw_line.strip()
+    if not stripped:
+        return
+    line = stripped.decode(errors="replace")
+
+    if is_stderr:
+        await queue_reply(update, context, f"Error: {line}")
+        user_data['errors'].append(line)
+        return
+
+    await queue_reply(update, context, line)
+    user_data['output'].append(line)
+    if is_prompt(line):
+        wait_for_input(context)
+        await flush_replies(update, context)
+
+def wait_for_input(context: CallbackContext) -> None:
+    user_data = context.user_data
+    deadline = user_data['deadline']
+    if user_data['waiting_for_input'] or deadline.expired():
+        return
+    now = asyncio.get_running_loop().time()
+    user_data['waiting_for_input'] = True
+    user_data['run_time_left'] -= now - user_data['resumed_at']
+    deadline.reschedule(now + INPUT_TIMEOUT)
+
+def resume_program(context: CallbackContext) -> None:
+    user_data = context.user_data
+    deadline = user_data['deadline']
+    if deadline.expired():
+        return
+    now = asyncio.get_running_loop().time()
+    user_data['waiting_for_input'] = False
+    user_data['resumed_at'] = now
+    deadline.reschedule(now + user_data['run_time_left'])
+
+async def stop_for_output_limit(update: Update, context: CallbackContext):
+    user_data = context.user_data
+    process = user_data['process']
+    if process.returncode is None:
+        signal_program(process, signal.SIGKILL)
+    if not user_data.get('output_truncated'):
+        user_data['output_truncated'] = True
+        notice = f"Program output exceeded {MAX_OUTPUT} bytes; output is truncated."
+        await queue_reply(update, context, notice)
+        user_data['errors'].append(notice)
+
+def reading_stdin(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/syscall") as f:
+            if f.read().split()[:2] == [READ_SYSCALL, "0x0"]:
+                return True
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+    except OSError:
+        return False
+    return any(reading_stdin(int(child)) for child in children)
+
+async def watch_program(update: Update, context: CallbackContext):
+    user_data = context.user_data
+    process = user_data['process']
+    was_reading = False
     while process.returncode is None:
-        stdout_line = (await process.stdout.readline()).decode().strip()
-        stderr_line = (await process.stderr.readline()).decode().strip()
-        
-        if stdout_line:
-            await update.message.reply_text(stdout_line)
-            context.user_data['output'].append(stdout_line)
-            if stdout_line.endswith(":") or "enter" in stdout_line.lower():
-                context.user_data['waiting_for_input'] = True
-                return
-        
-        if stderr_line:
-            await update.message.reply_text(f"Error: {stderr_line}")
-            context.user_data['errors'].append(stderr_line)
+        await asyncio.sleep(INPUT_POLL_INTERVAL)
+        if not READ_SYSCALL or user_data['waiting_for_input']:
+            was_reading = False
+            continue
+        is_reading = reading_stdin(process.pid)
+        if is_reading and was_reading:
+            async with user_data['line_lock']:
+                partial, user_data['stdout_partial'] = user_data['stdout_partial'], b""
+                await handle_line(partial, update, context, is_stderr=False)
+            wait_for_input(context)
+            await flush_replies(update, context)
+        was_reading = is_reading
+    signal_program(process, signal.SIGKILL)
 
-    await generate_and_send_pdf(update, context)
+async def run_program(update: Update, context: CallbackContext):
+    user_data = context.user_data
+    process = user_data['process']
+    watcher = None
+    try:
+        try:
+            async with asyncio.timeout(RUN_TIMEOUT) as deadline:
+                user_data['deadline'] = deadline
+                user_data['run_time_left'] = RUN_TIMEOUT
+                user_data['resumed_at'] = asyncio.get_running_loop().time()
+                watcher = user_data['watcher'] = asyncio.create_task(watch_program(update, context))
+                await asyncio.gather(
+                    read_stream(process.stdout, update, context, is_stderr=False),
+                    read_stream(process.stderr, update, context, is_stderr=True)
+                )
+                await process.wait()
+        except TimeoutError:
+            signal_program(process, signal.SIGKILL)
+            await process.wait()
+            if user_data['waiting_for_input']:
+                notice = f"No input received within {INPUT_TIMEOUT} seconds; the program was stopped."
+            else:
+                notice = f"Program timed out after {RUN_TIMEOUT} seconds; output is truncated."
+            await queue_reply(update, context, notice)
+            user_data['errors'].append(notice)
+        finally:
+            if watcher:
+                watcher.cancel()
+
+        await flush_replies(update, context)
+        await generate_and_send_pdf(update, context)
+    finally:
+        if user_data.get('runner') is asyncio.current_task():
+            await cleanup(context)
 
 async def handle_running(update: Update, context: CallbackContext) -> int:
-    user_input = update.message.text
-    process = context.user_data.get('process')
+    message = update.message
+    user_data = context.user_data
+    user_input = message.text
+    process = user_data.get('process')
     
-    if not process or process.returncode is not None:
-        await update.message.reply_text("Program is not running anymore.")
+    if process and process.returncode is not None:
+        await message.reply_text("Program has finished. Your PDF is on its way.")
+        return RUNNING
+
+    if not process:
+        await message.reply_text("Program is not running anymore.")
         return ConversationHandler.END
     
-    if not context.user_data.get('waiting_for_input', False):
-        await update.message.reply_text("Program isn't waiting for input right now. Please wait for a prompt.")
+    if not user_data.get('waiting_for_input', False):
+        await message.reply_text("Program isn't waiting for input right now. Please wait for a prompt.")
         return RUNNING
     
-    process.stdin.write((user_input + "\n").encode())
-    await process.stdin.drain()
-    context.user_data['inputs'].append(user_input)
-    context.user_data['waiting_for_input'] = False
-    
-    asyncio.create_task(read_process_output(update, context))
+    try:
+        await write_input(user_data['terminal'], (user_input + "\n").encode())
+    except OSError:
+        await message.reply_text("Program exited before reading your input.")
+        return RUNNING
+    except TimeoutError:
+        await message.reply_text("Program stopped reading input; waiting for it to finish.")
+        return RUNNING
+    user_data['inputs'].append(user_input)
+    resume_program(context)
     return RUNNING
 
+def find_font(filename: str) -> str | None:
+    for font_dir in FONT_DIRS:
+        for dirpath, _, filenames in os.walk(font_dir):
+            if filename in filenames:
+                return os.path.join(dirpath, filename)
+    return None
+
+def register_pdf_font() -> None:
+    path = PDF_FONT or find_font(PDF_FONT_FILE)
+    if not path:
+        logger.warning("%s not found; PDFs use Courier, which cannot show non-Latin-1 text", PDF_FONT_FILE)
+        return
+    pdfmetrics.registerFont(TTFont("CodeFont", path))
+    PDF_STYLES['Code'].fontName = "CodeFont"
+
+def pdf_line_length(doc: SimpleDocTemplate) -> int:
+    style = PDF_STYLES['Code']
+    frame = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height)
+    text_width = doc.width - frame.leftPadding - frame.rightPadding - style.leftIndent
+    return int(text_width // pdfmetrics.stringWidth("M", style.fontName, style.fontSize))
+
+def render_pdf(code: str, output: str, errors: str) -> bytes:
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    line_length = pdf_line_length(doc)
+    story = []
+    for title, text in zip(PDF_SECTIONS, (code, output, errors)):
+        story.append(Paragraph(title, PDF_STYLES['Heading1']))
+        story.append(Preformatted(text.expandtabs(4), PDF_STYLES['Code'], maxLineLength=line_length, newLineChars=''))
+    doc.build(story)
+    return buffer.getvalue()
+
 async def generate_and_send_pdf(update: Update, context: CallbackContext):
     code = context.user_data['code']
     output = "\n".join(context.user_data['output'])
     errors = "\n".join(context.user_data['errors'])
-    
-    pdf_content = f"""
-    <html>
-    <body>
-        <h1>Source Code</h1>
-        <pre><code>{code}</code></pre>
-        <h1>Program Output</h1>
-        <pre>{output}</pre>
-        <h1>Errors (if any)</h1>
-        <pre>{errors}</pre>
-    </body>
-    </html>
-    """
-    
-    with open("output.pdf", "wb") as f:
-        f.write(pdf_content.encode())
-    
-    with open('output.pdf', 'rb') as pdf_file:
-        await context.bot.send_document(chat_id=update.effective_chat.id, document=pdf_file)
-    
-    await update.message.reply_text("Execution completed! Here's your PDF with results.")
-    await cleanup(context)
+    key = hashlib.blake2b(repr((code, output, errors)).encode(), digest_size=16).hexdigest()
+
+    document = sent_pdfs.get(key)
+    if document:
+        sent_pdfs.move_to_end(key)
+    else:
+        pdf_bytes = await asyncio.to_thread(render_pdf, code, output, errors)
+        document = io.BytesIO(pdf_bytes)
+    sent = await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=document,
+        filename="output.pdf",
+        caption="Execution completed! Here's your PDF with results."
+    )
+    if sent.document:
+        sent_pdfs[key] = sent.document.file_id
+        if len(sent_pdfs) > PDF_CACHE_SIZE:
+            sent_pdfs.popitem(last=False)
+
+def track_cleanup(coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    cleanup_tasks.add(task)
+    task.add_done_callback(cleanup_tasks.discard)
+
+def release_program(process: asyncio.subprocess.Process, terminal: int, workdir: str) -> None:
+    running_processes.discard(process)
+    os.close(terminal)
+    track_cleanup(stop_program(process))
+    track_cleanup(asyncio.to_thread(shutil.rmtree, workdir, ignore_errors=True))
 
 async def cleanup(context: CallbackContext):
-    process = context.user_data.get('process')
-    if process and process.returncode is None:
-        process.terminate()
-    for file in ["temp.c", "temp", "output.pdf"]:
-        if os.path.exists(file):
-            os.remove(file)
-    context.user_data.clear()
+    user_data = context.user_data
+    runner = user_data.pop('runner', None)
+    for task in (runner, user_data.pop('watcher', None), user_data.pop('flush_task', None)):
+        if task and task is not asyncio.current_task():
+            task.cancel()
+    workdir = user_data.pop('workdir', None)
+    if workdir and not runner:
+        track_cleanup(asyncio.to_thread(shutil.rmtree, workdir, ignore_errors=True))
+    user_data.clear()
 
 async def cancel(update: Update, context: CallbackContext) -> int:
     await update.message.reply_text("Operation cancelled.")
     await cleanup(context)
     return ConversationHandler.END
 
+async def conversation_timed_out(update: Update, context: CallbackContext) -> None:
+    await cleanup(context)
+
+async def stats(update: Update, context: CallbackContext) -> None:
+    await update.message.reply_text(
+        f"Compiles running or queued: {pending_compiles} (limit {MAX_COMPILES} at once)\n"
+        f"Programs running: {len(running_processes)}/{MAX_RUNNING}\n"
+        f"Cached binaries: {len(compiled_binaries)}/{CACHE_SIZE}"
+    )
+
+async def shutdown(application: Application) -> None:
+    processes = list(running_processes)
+    for process in processes:
+        signal_program(process, signal.SIGTERM)
+    try:
+        async with asyncio.timeout(5):
+            await asyncio.gather(*(process.wait() for process in processes), return_exceptions=True)
+    except TimeoutError:
+        stragglers = [process for process in processes if process.returncode is None]
+        logger.warning("Killing %d user programs that ignored SIGTERM", len(stragglers))
+        for process in stragglers:
+            signal_program(process, signal.SIGKILL)
+        await asyncio.gather(*(process.wait() for process in stragglers), return_exceptions=True)
+    running_processes.clear()
+    await asyncio.gather(*cleanup_tasks, return_exceptions=True)
+    await asyncio.gather(*(remove_cgroup(cgroup) for cgroup in program_cgroups.values()))
+    program_cgroups.clear()
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(sys.maxsize)
+        self.update_slots = asyncio.Semaphore(max_concurrent_updates)
+        self.chat_locks = {}
+        self.chat_updates = Counter()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        key = chat.id if chat else None
+        lock = self.chat_locks.setdefault(key, asyncio.Lock())
+        self.chat_updates[key] += 1
+        try:
+            async with lock, self.update_slots:
+                await coroutine
+        finally:
+            self.chat_updates[key] -= 1
+            if not self.chat_updates[key]:
+                del self.chat_updates[key], self.chat_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 def main() -> None:
-    application = Application.builder().token(TOKEN).build()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    global BWRAP
+    if BWRAP and not sandbox_works():
+        BWRAP = None
+    if not BWRAP and ALLOW_UNSANDBOXED:
+        logger.warning("bwrap unavailable; running user programs WITHOUT a sandbox because ALLOW_UNSANDBOXED=1")
+    elif not BWRAP:
+        logger.error("bwrap unavailable; user programs will not be run. Install bubblewrap to enable execution.")
+    if CGROUP_DIR:
+        prepare_cgroups()
+    else:
+        logger.warning("CGROUP_DIR is not set; user programs have no limit on the number of processes")
+    make_private_dir(CACHE_DIR)
+    make_private_dir(WORK_DIR)
+    load_compiled_binaries()
+    remove_stale_workdirs()
+    register_pdf_font()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .pool_timeout(30)
+        .read_timeout(30)
+        .http_version("2")
+        .concurrent_updates(ChatUpdateProcessor(MAX_UPDATES))
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_shutdown(shutdown)
+        .build()
+    )
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', start), CommandHandler('check', check)],
         states={
             CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_code)],
             RUNNING: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_running)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timed_out)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     application.add_handler(conv_handler)
-    application.run_polling()
+    application.add_handler(CommandHandler('stats', stats))
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=urlsplit(WEBHOOK_URL).path.lstrip('/'),
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=WEBHOOK_URL,
+            drop_pending_updates=True
+        )
+    else:
+        application.run_polling(drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()